@@ -11,7 +11,17 @@ Copyright (c) 2025 the_louie
 
 import appdaemon.plugins.hass.hassapi as hass
 import datetime
-import traceback
+
+
+def _parse_hhmm(value: str) -> datetime.time:
+    """Parse an "HH:MM" string into a time, raising ValueError if malformed."""
+    hours, minutes = value.split(":", 1)
+    return datetime.time(int(hours), int(minutes))
+
+
+def _is_summer(month: int) -> bool:
+    """Return True for the summer months (June-August)."""
+    return 6 <= month <= 8
 
 
 class GrowLights(hass.Hass):
@@ -23,7 +33,8 @@ class GrowLights(hass.Hass):
             # Get configuration parameters
             self.uv_sensor = self.args.get("uv_index_sensor")
             self.uv_threshold = self.args.get("uv_index_threshold", 5)
-            self.switches = self.args.get("switches", [])
+            self.uv_hysteresis = self.args.get("uv_index_hysteresis", 0.5)
+            switches = self.args.get("switches", [])
 
             # Time configuration
             self.off_season_start = self.args.get("off_season_start", "09:00")
@@ -36,86 +47,198 @@ class GrowLights(hass.Hass):
                 self.log("Error: UV index sensor not configured", level="ERROR")
                 return
 
-            if not self.switches:
+            if not switches:
                 self.log("Error: No switches configured", level="ERROR")
                 return
 
+            if not isinstance(switches, list) or not all(isinstance(switch, str) for switch in switches):
+                self.log("Error: Switches must be a list of entity IDs", level="ERROR")
+                return
+            self.switches = tuple(switches)
+
+            # Convert thresholds to float once, so checks compare floats only
+            try:
+                self.uv_threshold = float(self.uv_threshold)
+                self.uv_hysteresis = float(self.uv_hysteresis)
+            except (ValueError, TypeError) as e:
+                self.log(f"Error: UV index threshold and hysteresis must be numbers: {str(e)}", level="ERROR")
+                return
+
+            if not 0 <= self.uv_hysteresis < self.uv_threshold:
+                self.log("Error: UV index hysteresis must be at least 0 and below the UV index threshold", level="ERROR")
+                return
+
             # Parse time strings once for efficiency
             try:
-                self.off_season_start_time = datetime.datetime.strptime(self.off_season_start, "%H:%M").time()
-                self.off_season_end_time = datetime.datetime.strptime(self.off_season_end, "%H:%M").time()
-                self.on_season_start_time = datetime.datetime.strptime(self.on_season_start, "%H:%M").time()
-                self.on_season_end_time = datetime.datetime.strptime(self.on_season_end, "%H:%M").time()
+                self.off_season_start_time = _parse_hhmm(self.off_season_start)
+                self.off_season_end_time = _parse_hhmm(self.off_season_end)
+                self.on_season_start_time = _parse_hhmm(self.on_season_start)
+                self.on_season_end_time = _parse_hhmm(self.on_season_end)
             except ValueError as e:
-                self.log(f"Error parsing time configuration: {str(e)} (line {traceback.extract_stack()[-1].lineno})", level="ERROR")
+                self.log(f"Error parsing time configuration: {str(e)} (line {e.__traceback__.tb_lineno})", level="ERROR")
                 raise
 
-            # Schedule initial check
-            self.run_in(self.check_conditions, 0)
-
-            # Schedule periodic UV index checks (every 10 minutes)
-            self.run_every(self.check_conditions, "now", 10 * 60)
+            # Active windows as minute-of-day for cheap integer comparisons
+            self._off_start_mod = self.off_season_start_time.hour * 60 + self.off_season_start_time.minute
+            self._off_end_mod = self.off_season_end_time.hour * 60 + self.off_season_end_time.minute
+            self._on_start_mod = self.on_season_start_time.hour * 60 + self.on_season_start_time.minute
+            self._on_end_mod = self.on_season_end_time.hour * 60 + self.on_season_end_time.minute
+
+            # Active window (start, end) per month, indexed by month - 1
+            self._window_by_month = tuple(
+                (self._on_start_mod, self._on_end_mod) if _is_summer(month) else (self._off_start_mod, self._off_end_mod)
+                for month in range(1, 13)
+            )
+
+            # Lights turn off at the threshold but, once off because of UV,
+            # only turn back on below threshold - hysteresis
+            self._off_threshold = self.uv_threshold
+            self._on_threshold = self.uv_threshold - self.uv_hysteresis
+            self._uv_off = False
+
+            # Cached light state as confirmed by Home Assistant ("on"/"off", None when unknown),
+            # re-synced every 6 checks
+            self._light_state = None
+            self._checks_since_sync = 0
+            self.listen_state(self._on_switch_change, self.switches[0])
+
+            # React to UV index changes as they happen; the periodic check is only a safety net
+            self.listen_state(self._on_uv_change, self.uv_sensor)
+
+            # Arm the periodic re-checks only while lights may be on
+            self.check_handle = None
+            for is_summer, start, end in (
+                (True, self.on_season_start_time, self.on_season_end_time),
+                (False, self.off_season_start_time, self.off_season_end_time),
+            ):
+                self.run_daily(self._start_active_window, start, summer=is_summer)
+                self.run_daily(self._stop_active_window, end, summer=is_summer)
+
+            # Schedule initial check, through the periodic check if already in the active window
+            if self.is_active_time(self.datetime()):
+                self._start_active_window({})
+            else:
+                self.run_in(self.check_conditions, 0)
 
             self.log("Grow Lights app initialized successfully", level="INFO")
 
         except Exception as e:
-            self.log(f"Error initializing Grow Lights app: {str(e)} (line {traceback.extract_stack()[-1].lineno})", level="ERROR")
+            self.log(f"Error initializing Grow Lights app: {str(e)} (line {e.__traceback__.tb_lineno})", level="ERROR")
+
+    def is_active_time(self, now: datetime.datetime) -> bool:
+        """Return True if the given time is within the active hours of its season."""
+        start, end = self._window_by_month[now.month - 1]
+        return start <= now.hour * 60 + now.minute < end
+
+    def _start_active_window(self, kwargs) -> None:
+        """Start periodic re-checks (every 30 minutes) at the beginning of the active window."""
+        try:
+            if "summer" in kwargs and kwargs["summer"] != _is_summer(self.datetime().month):
+                return
+            self._arm_checks("now")
+
+        except Exception as e:
+            self.log(f"Error starting active window: {str(e)} (line {e.__traceback__.tb_lineno})", level="ERROR")
+
+    def _stop_active_window(self, kwargs) -> None:
+        """Turn lights off at the end of the active window; periodic checks stop once they are off."""
+        try:
+            if "summer" in kwargs and kwargs["summer"] != _is_summer(self.datetime().month):
+                return
+            self.check_conditions({})
+
+        except Exception as e:
+            self.log(f"Error stopping active window: {str(e)} (line {e.__traceback__.tb_lineno})", level="ERROR")
+
+    def _arm_checks(self, start) -> None:
+        """Start the periodic re-checks (every 30 minutes) unless they are already running."""
+        if self.check_handle is None:
+            self.check_handle = self.run_every(self.check_conditions, start, 30 * 60)
+
+    def _on_switch_change(self, entity, attribute, old, new, kwargs) -> None:
+        """Keep the cached light state in sync with the first switch."""
+        self._light_state = new if new in ("on", "off") else None
+
+    def _on_uv_change(self, entity, attribute, old, new, kwargs) -> None:
+        """Check conditions with the new UV index value as soon as it changes."""
+        self.check_conditions({"uv_state": new})
 
     def control_lights(self, turn_on: bool) -> None:
         """Control all configured growth light switches."""
-        try:
-            action = "on" if turn_on else "off"
-            self.log(f"Turning lights {action}", level="INFO")
+        action = "on" if turn_on else "off"
+        self.log(f"Turning lights {action}", level="INFO")
 
-            for switch in self.switches:
-                try:
-                    self.turn_on(switch) if turn_on else self.turn_off(switch)
-                except Exception as e:
-                    self.log(f"Error controlling switch {switch}: {str(e)} (line {traceback.extract_stack()[-1].lineno})", level="ERROR")
+        # The state is unknown until the switch confirms it through _on_switch_change
+        self._light_state = None
 
+        # Control all switches with a single, domain-agnostic service call. AppDaemon logs failed
+        # service calls rather than raising them, so the fallback below only covers local errors
+        try:
+            self.call_service(f"homeassistant/turn_{action}", entity_id=self.switches)
+            return
         except Exception as e:
-            self.log(f"Error controlling lights: {str(e)} (line {traceback.extract_stack()[-1].lineno})", level="ERROR")
+            self.log(f"Error controlling switches together, falling back to one by one: {str(e)} (line {e.__traceback__.tb_lineno})", level="WARNING")
+
+        control_switch = self.turn_on if turn_on else self.turn_off
+        for switch in self.switches:
+            try:
+                control_switch(switch)
+            except Exception as e:
+                self.log(f"Error controlling switch {switch}: {str(e)} (line {e.__traceback__.tb_lineno})", level="ERROR")
 
     def check_conditions(self, kwargs) -> None:
         """Main function to check conditions and control lights."""
         try:
-            # Get current time and month once (needed for active hours check)
-            now = datetime.datetime.now()
-            current_time = now.time()
-            current_month = now.month
-
-            # Check if we're in active hours (most likely to exit early)
-            is_summer = 6 <= current_month <= 8
-            is_active = (self.on_season_start_time <= current_time <= self.on_season_end_time) if is_summer else (self.off_season_start_time <= current_time <= self.off_season_end_time)
-
-            # Get current state (needed for both active and inactive logic)
-            current_state = self.get_state(self.switches[0])
-            if current_state is None:
-                return
-
             # If outside active hours, ensure lights are OFF
-            if not is_active:
-                if current_state == "on":
-                    self.control_lights(False)
+            now = self.datetime()
+            if not self.is_active_time(now):
+                self._uv_off = False
+                current_state = self._light_state
+                if current_state is None:
+                    current_state = self.get_state(self.switches[0])
+
+                # Once the lights are confirmed off, stay idle until the next active window
+                if current_state == "off":
+                    if self.check_handle is not None:
+                        self.cancel_timer(self.check_handle)
+                        self.check_handle = None
+                    return
+
+                # Otherwise turn them off and keep re-checking until the switch confirms it
+                self.control_lights(False)
+                self._arm_checks(now + datetime.timedelta(minutes=30))
                 return
 
-            # We're in active hours - get UV index (most expensive operation)
+            # Get current state, only asking Home Assistant when the cache is empty or due for a re-sync
+            self._checks_since_sync += 1
+            current_state = self._light_state
+            if current_state is None or self._checks_since_sync >= 6:
+                current_state = self.get_state(self.switches[0])
+                if current_state is None:
+                    return
+                self._light_state = current_state
+                self._checks_since_sync = 0
+
+            # Get UV index (most expensive operation), -1.0 if unavailable or unknown
+            uv_state = kwargs["uv_state"] if "uv_state" in kwargs else self.get_state(self.uv_sensor)
             try:
-                uv_state = self.get_state(self.uv_sensor)
-                uv_index = float(uv_state) if uv_state is not None and uv_state != "unavailable" else None
+                uv_index = float(uv_state) if uv_state not in (None, "unavailable", "unknown") else -1.0
             except (ValueError, TypeError) as e:
-                self.log(f"Error parsing UV index value: {str(e)} (line {traceback.extract_stack()[-1].lineno})", level="ERROR")
-                uv_index = None
+                self.log(f"Error parsing UV index value: {str(e)} (line {e.__traceback__.tb_lineno})", level="ERROR")
+                uv_index = -1.0
 
-            # Determine desired state based on UV index
-            should_be_on = uv_index is None or uv_index < self.uv_threshold
+            # Determine desired state based on UV index, with hysteresis to avoid flapping
+            # (the lower turn-on threshold only applies while lights are off because of UV)
+            threshold = self._on_threshold if self._uv_off and current_state != "on" else self._off_threshold
+            should_be_on = uv_index < 0 or uv_index < threshold
 
             # Return early if no state change needed
-            if (should_be_on and current_state == "on") or (not should_be_on and current_state == "off"):
+            if current_state == ("on" if should_be_on else "off"):
                 return
 
             # Control lights
+            self._uv_off = not should_be_on
             self.control_lights(should_be_on)
 
         except Exception as e:
-            self.log(f"Error in check_conditions: {str(e)} (line {traceback.extract_stack()[-1].lineno})", level="ERROR")
+            self.log(f"Error in check_conditions: {str(e)} (line {e.__traceback__.tb_lineno})", level="ERROR")